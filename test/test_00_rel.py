@@ -1,6 +1,8 @@
-from collections.abc import Iterable
+from collections.abc import Iterable, Iterator
 from itertools import product
 from math import ceil, isqrt, prod, sqrt
+from typing import Any, NamedTuple
+import numpy as np
 import pytest
 from numpy.random import Generator, default_rng
 from pyroaring import BitMap64
@@ -22,258 +24,353 @@ shape_samples = [
     tuple(map(int, rng.choice(SET_SIZES, arity, replace=True)))
     for arity in arity_samples
 ]
-rel_param_samples: dict[Shape, list[frozenset[Entry]]] = {}
+rel_param_samples: dict[Shape, list[tuple[Entry, ...]]] = {}
 for shape in shape_samples:
-    entryset_samples: list[frozenset[Entry]] = []
+    if shape in rel_param_samples:
+        # Repeated shapes would only regenerate (and discard) entryset samples:
+        continue
+    entryset_samples: list[tuple[Entry, ...]] = []
     rel_param_samples[shape] = entryset_samples
     all_entries = tuple(Rel.iter_entries(shape))
+    all_entries_arr = np.empty(len(all_entries), dtype=object)
+    all_entries_arr[:] = all_entries
     total_size = prod(shape)
-    entryset_samples.append(frozenset())
+    entryset_samples.append(())
     if total_size > 1:
         rel_size_samples = rng.integers(1, total_size, NUM_REL_SAMPLES)
+        perm = all_entries_arr.copy()
         for rel_size in rel_size_samples:
-            entryset = frozenset(
-                tuple(map(int, _entry))
-                for _entry in rng.choice(all_entries, rel_size, replace=False)
-            )
+            rng.shuffle(perm)
+            entryset = tuple(perm[:rel_size].tolist())
             entryset_samples.append(entryset)
-    entryset_samples.append(frozenset(all_entries))
+    entryset_samples.append(all_entries)
+
+ALL_ENTRIES: dict[Shape, frozenset[Entry]] = {
+    shape: frozenset(Rel.iter_entries(shape)) for shape in rel_param_samples
+}
+MISSING_ENTRIES: dict[tuple[Shape, int], frozenset[Entry]] = {
+    (shape, entryset_id): ALL_ENTRIES[shape].difference(entryset)
+    for shape, entryset_samples in rel_param_samples.items()
+    for entryset_id, entryset in enumerate(entryset_samples)
+}
+bitmap_samples: dict[tuple[Shape, int], BitMap64] = {
+    (shape, entryset_id): Rel(shape, entryset)._Rel__data  # type: ignore[attr-defined]
+    for shape, entryset_samples in rel_param_samples.items()
+    for entryset_id, entryset in enumerate(entryset_samples)
+}
+EMPTY_RELS: dict[Shape, Rel] = {shape: Rel(shape) for shape in rel_param_samples}
+FULL_RELS: dict[Shape, Rel] = {
+    shape: Rel(shape, entries) for shape, entries in ALL_ENTRIES.items()
+}
+
+
+SHAPE_IDS: dict[Shape, int] = {shape: i for i, shape in enumerate(rel_param_samples)}
+
+
+def with_sample_ids(samples: Iterable[tuple[Any, ...]]) -> list[Any]:
+    """
+    Wraps parametrizations, whose first argument is the shape, with test IDs made
+    from the shape index and the entryset IDs in the sample.
+    """
+    params: list[Any] = []
+    for shape, *args in samples:
+        entryset_ids = [arg for arg in args if isinstance(arg, int)]
+        sample_id = "-".join(map(str, [SHAPE_IDS[shape], *entryset_ids]))
+        params.append(pytest.param(shape, *args, id=sample_id))
+    return params
 
 
 @pytest.mark.parametrize(
-    "shape,entryset",
-    [
-        (shape, entryset)
+    "shape", with_sample_ids((shape,) for shape in rel_param_samples)
+)
+def test_validate_entries_per_shape(shape: Shape) -> None:
+    rel = Rel(shape)
+    for entry in ALL_ENTRIES[shape]:
+        rel.validate_entry(entry)
+
+
+@pytest.mark.parametrize(
+    "shape,entryset_id",
+    with_sample_ids(
+        (shape, entryset_id)
         for shape, entryset_samples in rel_param_samples.items()
-        for entryset in entryset_samples
-    ],
+        for entryset_id in range(len(entryset_samples))
+    ),
 )
-def test_constructor(shape: Shape, entryset: frozenset[Entry]) -> None:
-    all_entries = frozenset(Rel.iter_entries(shape))
-    missing_entries = all_entries - entryset
+def test_constructor(shape: Shape, entryset_id: int) -> None:
+    entryset = rel_param_samples[shape][entryset_id]
     rel = Rel(shape, entryset)
     assert rel.shape == shape
     assert len(rel) == len(entryset)
-    assert frozenset(rel) == entryset
+    assert frozenset(rel) == frozenset(entryset)
     assert all(entry in rel for entry in entryset)
-    assert all(entry not in rel for entry in missing_entries)
-    for entry in all_entries:
-        rel.validate_entry(entry)
+    assert not any(entry in rel for entry in MISSING_ENTRIES[shape, entryset_id])
     with pytest.raises(ValueError):
         bitmap = BitMap64([prod(shape)])
         Rel(shape, bitmap)
 
 
 @pytest.mark.parametrize(
-    "shape,entryset",
-    [
-        (shape, entryset)
+    "shape,entryset_id",
+    with_sample_ids(
+        (shape, entryset_id)
         for shape, entryset_samples in rel_param_samples.items()
-        for entryset in entryset_samples
-    ],
+        for entryset_id in range(len(entryset_samples))
+    ),
 )
-def test_copy(shape: Shape, entryset: frozenset[Entry]) -> None:
-    all_entries = frozenset(Rel.iter_entries(shape))
-    missing_entries = all_entries - entryset
+def test_copy(shape: Shape, entryset_id: int) -> None:
+    entryset = rel_param_samples[shape][entryset_id]
     rel = Rel(shape, entryset)
+    expected = frozenset(entryset)
+
+    def _check(copy: Rel) -> None:
+        assert copy.shape == shape
+        assert frozenset(copy) == expected
+        assert rel == copy
+
     # copy() method:
-    copy = rel.copy()
-    assert copy.shape == shape
-    assert len(copy) == len(entryset)
-    assert frozenset(copy) == entryset
-    assert all(entry in copy for entry in entryset)
-    assert all(entry not in copy for entry in missing_entries)
-    for entry in all_entries:
-        copy.validate_entry(entry)
-    assert rel == copy
+    _check(rel.copy())
     # Rel copy constructor:
-    copy = Rel(shape, rel)
-    assert copy.shape == shape
-    assert len(copy) == len(entryset)
-    assert frozenset(copy) == entryset
-    assert all(entry in copy for entry in entryset)
-    assert all(entry not in copy for entry in missing_entries)
-    for entry in all_entries:
-        copy.validate_entry(entry)
-    assert rel == copy
+    _check(Rel(shape, rel))
     # BitMap64 copy constructor:
-    copy = Rel(shape, rel._Rel__data) # type: ignore[attr-defined]
-    assert copy.shape == shape
-    assert len(copy) == len(entryset)
-    assert frozenset(copy) == entryset
-    assert all(entry in copy for entry in entryset)
-    assert all(entry not in copy for entry in missing_entries)
-    for entry in all_entries:
-        copy.validate_entry(entry)
-    assert rel == copy
+    _check(Rel(shape, rel._Rel__data))  # type: ignore[attr-defined]
+
 
 @pytest.mark.parametrize(
-    "shape,entryset",
-    [
-        (shape, entryset)
+    "shape,entryset_id",
+    with_sample_ids(
+        (shape, entryset_id)
         for shape, entryset_samples in rel_param_samples.items()
-        for entryset in entryset_samples
-    ],
+        for entryset_id in range(len(entryset_samples))
+    ),
 )
-def test_invert(shape: Shape, entryset: frozenset[Entry]) -> None:
-    all_entries = frozenset(Rel.iter_entries(shape))
-    missing_entries = all_entries - entryset
-    rel = Rel(shape, entryset)
+def test_invert(shape: Shape, entryset_id: int) -> None:
+    missing_entries = MISSING_ENTRIES[shape, entryset_id]
+    rel = Rel(shape, bitmap_samples[shape, entryset_id])
     rel_inv = ~rel
     assert rel_inv.shape == shape
-    assert len(rel_inv) == len(missing_entries)
     assert frozenset(rel_inv) == missing_entries
-    assert all(entry not in rel_inv for entry in entryset)
-    assert all(entry in rel_inv for entry in missing_entries)
-    for entry in all_entries:
-        rel_inv.validate_entry(entry)
 
 
 NUM_REL_SAMPLES_ISQRT = isqrt(NUM_REL_SAMPLES) + 1
 
 
 def select_entryset_samples(
-    entryset_samples: list[frozenset[Entry]], num_samples: int
-) -> list[frozenset[Entry]]:
+    entryset_samples: list[tuple[Entry, ...]], num_samples: int
+) -> list[int]:
     assert len(entryset_samples) >= 2
-    selected_samples = [entryset_samples[0]]
-    if len(entryset_samples) > 2:
-        selected_samples.extend(rng.choice(entryset_samples[1:-1], num_samples))  # type: ignore
-    selected_samples.append(entryset_samples[-1])
-    return selected_samples
+    last_id = len(entryset_samples) - 1
+    selected_ids = [0]
+    if last_id > 1:
+        selected_ids.extend(map(int, rng.integers(1, last_id, num_samples)))
+    selected_ids.append(last_id)
+    return selected_ids
 
 
-rel_pair_samples: dict[Shape, list[tuple[frozenset[Entry], frozenset[Entry]]]] = {}
+rel_pair_samples: dict[Shape, list[tuple[int, int]]] = {}
 for shape, entryset_samples in rel_param_samples.items():
     lhs_samples = select_entryset_samples(entryset_samples, NUM_REL_SAMPLES_ISQRT)
     rhs_samples = select_entryset_samples(entryset_samples, NUM_REL_SAMPLES_ISQRT)
     rel_pair_samples[shape] = list(product(lhs_samples, rhs_samples))
 
+# Containment checks don't need the full pair grid: each shape gets the diagonal,
+# the (empty, full) and (full, empty) pairs, and a few random pairs (deduplicated).
+rel_containment_samples: dict[Shape, list[tuple[int, int]]] = {}
+for shape, entryset_samples in rel_param_samples.items():
+    last_id = len(entryset_samples) - 1
+    containment_samples = [(i, i) for i in range(last_id + 1)]
+    containment_samples.extend([(0, last_id), (last_id, 0)])
+    containment_samples.extend(
+        (int(lhs_id), int(rhs_id))
+        for lhs_id, rhs_id in rng.integers(0, last_id + 1, (NUM_REL_SAMPLES_ISQRT, 2))
+    )
+    rel_containment_samples[shape] = list(dict.fromkeys(containment_samples))
+
+
+class BinopResults(NamedTuple):
+    """Expected results of binary operations on a pair of sample entrysets."""
+
+    intersection: frozenset[Entry]
+    union: frozenset[Entry]
+    symmetric_difference: frozenset[Entry]
+    difference: frozenset[Entry]
+
+
+def iter_binop_samples() -> Iterator[tuple[Shape, int, int, BinopResults]]:
+    for shape, entryset_pair_samples in rel_pair_samples.items():
+        entrysets = list(map(frozenset, rel_param_samples[shape]))
+        for lhs_id, rhs_id in entryset_pair_samples:
+            lhs_entryset = entrysets[lhs_id]
+            rhs_entryset = entrysets[rhs_id]
+            expected = BinopResults(
+                lhs_entryset & rhs_entryset,
+                lhs_entryset | rhs_entryset,
+                lhs_entryset ^ rhs_entryset,
+                lhs_entryset - rhs_entryset,
+            )
+            yield (shape, lhs_id, rhs_id, expected)
+
+
+rel_pair_binop_samples = list(iter_binop_samples())
+
+
+class RelCache(dict[tuple[Shape, int], Rel]):
+    """Lazily builds and caches sample relations, keyed by shape and entryset ID."""
+
+    def __missing__(self, key: tuple[Shape, int]) -> Rel:
+        shape, _ = key
+        rel = self[key] = Rel(shape, bitmap_samples[key])
+        return rel
+
+
+@pytest.fixture(scope="session")
+def rel_cache() -> RelCache:
+    return RelCache()
+
 
 @pytest.mark.parametrize(
-    "shape,lhs_entryset,rhs_entryset",
-    [
-        (shape, lhs_entryset, rhs_entryset)
-        for shape, entryset_pair_samples in rel_pair_samples.items()
-        for lhs_entryset, rhs_entryset in entryset_pair_samples
-    ],
+    "shape,lhs_id,rhs_id,expected",
+    with_sample_ids(rel_pair_binop_samples),
 )
 def test_binops(
-    shape: Shape, lhs_entryset: frozenset[Entry], rhs_entryset: frozenset[Entry]
+    rel_cache: RelCache,
+    shape: Shape,
+    lhs_id: int,
+    rhs_id: int,
+    expected: BinopResults,
 ) -> None:
-    lhs = Rel(shape, lhs_entryset)
-    rhs = Rel(shape, rhs_entryset)
-    assert frozenset(lhs & rhs) == lhs_entryset & rhs_entryset
-    assert frozenset(lhs | rhs) == lhs_entryset | rhs_entryset
-    assert frozenset(lhs ^ rhs) == lhs_entryset ^ rhs_entryset
-    assert frozenset(lhs - rhs) == lhs_entryset - rhs_entryset
+    lhs = rel_cache[shape, lhs_id]
+    rhs = rel_cache[shape, rhs_id]
+    assert frozenset(lhs & rhs) == expected.intersection
+    assert frozenset(lhs | rhs) == expected.union
+    assert frozenset(lhs ^ rhs) == expected.symmetric_difference
+    assert frozenset(lhs - rhs) == expected.difference
 
 
 @pytest.mark.parametrize(
-    "shape,lhs_entryset,rhs_entryset",
-    [
-        (shape, lhs_entryset, rhs_entryset)
-        for shape, entryset_pair_samples in rel_pair_samples.items()
-        for lhs_entryset, rhs_entryset in entryset_pair_samples
-    ],
+    "shape,lhs_id,rhs_id,expected",
+    with_sample_ids(rel_pair_binop_samples),
 )
 def test_inplace_binops(
-    shape: Shape, lhs_entryset: frozenset[Entry], rhs_entryset: frozenset[Entry]
+    rel_cache: RelCache,
+    shape: Shape,
+    lhs_id: int,
+    rhs_id: int,
+    expected: BinopResults,
 ) -> None:
-    lhs = Rel(shape, lhs_entryset)
-    rhs = Rel(shape, rhs_entryset)
+    lhs = rel_cache[shape, lhs_id]
+    rhs = rel_cache[shape, rhs_id]
     res = lhs.copy()
     _res = res
     res &= rhs
-    assert res is _res and frozenset(_res) == lhs_entryset & rhs_entryset
+    assert res is _res and frozenset(_res) == expected.intersection
     res = lhs.copy()
     _res = res
     res |= rhs
-    assert res is _res and frozenset(_res) == lhs_entryset | rhs_entryset
+    assert res is _res and frozenset(_res) == expected.union
     res = lhs.copy()
     _res = res
     res ^= rhs
-    assert res is _res and frozenset(_res) == lhs_entryset ^ rhs_entryset
+    assert res is _res and frozenset(_res) == expected.symmetric_difference
     res = lhs.copy()
     _res = res
     res -= rhs
-    assert res is _res and frozenset(_res) == lhs_entryset - rhs_entryset
+    assert res is _res and frozenset(_res) == expected.difference
 
 
 @pytest.mark.parametrize(
-    "shape,lhs_entryset,rhs_entryset",
-    [
-        (shape, lhs_entryset, rhs_entryset)
-        for shape, entryset_pair_samples in rel_pair_samples.items()
-        for lhs_entryset, rhs_entryset in entryset_pair_samples
-    ],
+    "shape,lhs_id,rhs_id,expected",
+    with_sample_ids(rel_pair_binop_samples),
 )
 def test_inplace_updates(
-    shape: Shape, lhs_entryset: frozenset[Entry], rhs_entryset: frozenset[Entry]
+    rel_cache: RelCache,
+    shape: Shape,
+    lhs_id: int,
+    rhs_id: int,
+    expected: BinopResults,
 ) -> None:
-    lhs = Rel(shape, lhs_entryset)
+    rhs_entryset = rel_param_samples[shape][rhs_id]
+    lhs = rel_cache[shape, lhs_id]
     res = lhs.copy()
     _res = res
     res.update(rhs_entryset)
-    assert res is _res and frozenset(_res) == lhs_entryset | rhs_entryset
+    assert res is _res and frozenset(_res) == expected.union
     res = lhs.copy()
     _res = res
     res.symmetric_difference_update(rhs_entryset)
-    assert res is _res and frozenset(_res) == lhs_entryset ^ rhs_entryset
+    assert res is _res and frozenset(_res) == expected.symmetric_difference
     res = lhs.copy()
     _res = res
     res.difference_update(rhs_entryset)
-    assert res is _res and frozenset(_res) == lhs_entryset - rhs_entryset
+    assert res is _res and frozenset(_res) == expected.difference
+
+
+MAX_ENTRYWISE_UPDATES = 8
 
 
 @pytest.mark.parametrize(
-    "shape,lhs_entryset,rhs_entryset",
-    [
-        (shape, lhs_entryset, rhs_entryset)
-        for shape, entryset_pair_samples in rel_pair_samples.items()
-        for lhs_entryset, rhs_entryset in entryset_pair_samples
-    ],
+    "shape,lhs_id,rhs_id,expected",
+    with_sample_ids(rel_pair_binop_samples),
 )
 def test_inplace_entrywise_update(
-    shape: Shape, lhs_entryset: frozenset[Entry], rhs_entryset: frozenset[Entry]
+    rel_cache: RelCache,
+    shape: Shape,
+    lhs_id: int,
+    rhs_id: int,
+    expected: BinopResults,
 ) -> None:
-    lhs = Rel(shape, lhs_entryset)
+    rhs_entryset = rel_param_samples[shape][rhs_id]
+    lhs = rel_cache[shape, lhs_id]
+    if not rhs_entryset:
+        # No entries to add, flip or remove: all results coincide with lhs.
+        assert frozenset(lhs) == expected.union == expected.difference
+        assert frozenset(lhs) == expected.symmetric_difference
+        return
+    # Entrywise methods are exercised on at most MAX_ENTRYWISE_UPDATES rhs entries,
+    # spread evenly across the sorted entries, while the rest are applied in bulk:
+    rhs_entries = sorted(rhs_entryset)
+    stride = ceil(len(rhs_entries) / MAX_ENTRYWISE_UPDATES)
+    head = rhs_entries[::stride]
+    tail = [entry for i, entry in enumerate(rhs_entries) if i % stride]
     res = lhs.copy()
     _res = res
-    for entry in sorted(rhs_entryset):
+    for entry in head:
         res.add(entry)
-    assert res is _res and frozenset(_res) == lhs_entryset | rhs_entryset
+    res.update(tail)
+    assert res is _res and frozenset(_res) == expected.union
     res = lhs.copy()
     _res = res
-    for entry in sorted(rhs_entryset):
+    for entry in head:
         res.flip(entry)
-    assert res is _res and frozenset(_res) == lhs_entryset ^ rhs_entryset
+    res.symmetric_difference_update(tail)
+    assert res is _res and frozenset(_res) == expected.symmetric_difference
     res = lhs.copy()
     _res = res
-    for entry in sorted(rhs_entryset):
+    for entry in head:
         if entry in res:
             res.remove(entry)
         else:
             with pytest.raises(KeyError):
                 res.remove(entry)
-    assert res is _res and frozenset(_res) == lhs_entryset - rhs_entryset
+    res.difference_update(tail)
+    assert res is _res and frozenset(_res) == expected.difference
 
 
 @pytest.mark.parametrize(
-    "shape,lhs_entryset,rhs_entryset",
-    [
-        (shape, lhs_entryset, rhs_entryset)
-        for shape, entryset_pair_samples in rel_pair_samples.items()
-        for lhs_entryset, rhs_entryset in entryset_pair_samples
-    ],
+    "shape,lhs_id,rhs_id",
+    with_sample_ids(
+        (shape, lhs_id, rhs_id)
+        for shape, containment_samples in rel_containment_samples.items()
+        for lhs_id, rhs_id in containment_samples
+    ),
 )
 def test_containment(
-    shape: Shape, lhs_entryset: frozenset[Entry], rhs_entryset: frozenset[Entry]
+    rel_cache: RelCache, shape: Shape, lhs_id: int, rhs_id: int
 ) -> None:
-    lhs = Rel(shape, lhs_entryset)
-    rhs = Rel(shape, rhs_entryset)
-    empty = Rel(shape)
-    full = Rel(shape, Rel.iter_entries(shape))
+    lhs = rel_cache[shape, lhs_id]
+    rhs = rel_cache[shape, rhs_id]
+    empty = EMPTY_RELS[shape]
+    full = FULL_RELS[shape]
     assert empty <= lhs and empty <= rhs
     assert lhs <= full and rhs <= full
     assert lhs & rhs <= lhs and lhs & rhs <= rhs